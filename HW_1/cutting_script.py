@@ -6,4 +6,7 @@ MONGO_CLIENT = MongoClient(host = 'localhost:27017')
 cut_robot = CutRobot('c1')
 journal = Journal(MONGO_CLIENT)
 
-cut_robot.cut_branches(journal)
+try:
+    cut_robot.cut_branches(journal)
+finally:
+    journal.flush()
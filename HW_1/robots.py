@@ -1,91 +1,181 @@
 from dataclasses import dataclass
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from collections import namedtuple
 from typing import Any
 import pymongo
 
 
-MONGO_CLIENT = pymongo.MongoClient(host="localhost:27017")
 DailyData = namedtuple("DailyData", ["date", "amount"])
-WeeklyData = namedtuple("WeeklyData", ["week_number", "amount"])
+WeeklyData = namedtuple("WeeklyData", ["week_start", "amount"])
+SumSpec = namedtuple(
+    "SumSpec", ["field_to_match", "value", "field_to_sum", "operator"]
+)
+DailyStatus = namedtuple("DailyStatus", ["water_amount", "branches_to_cut"])
+# IndexOptionsConflict, IndexKeySpecsConflict
+INDEX_CONFLICT_CODES = (85, 86)
 
 
-class NotEnoughWaterError(Exception):
-    pass
+def _today_midnight() -> datetime:
+    """Returns start of the current day in UTC"""
+    return datetime.now(timezone.utc).replace(
+        hour=0, minute=0, second=0, microsecond=0
+    )
 
 
-class DBHelper:
-    """Set of methods for querying MongoDB"""
+class NotEnoughWaterError(Exception):
+    pass
 
-    @staticmethod
-    def sum_by_field_value(
-        collection: pymongo.collection.Collection,
-        field_to_match: str,
-        value: Any,
-        field_to_sum: str,
-        operator: str = None,
-    ):
-        """Returns sum of target field based on matching condition"""
-        if operator:
-            value = {operator: value}
 
-        pipeline = [
-            {"$match": {field_to_match: value}},
-            {"$group": {"_id": None, "total": {"$sum": f"${field_to_sum}"}}},
-        ]
-        result = list(collection.aggregate(pipeline))
-        return result[0]["total"] if result else 0
-
-    @staticmethod
-    def sum_field_by_date(
-        collection: pymongo.collection.Collection,
-        field,
-        timestamp_field_name="timestamp"
-    ):
-        """Returns docs with field grouped by date"""
-        pipeline = [
-            {
-                "$addFields": {
-                    "date": {"$dateToParts": {"date": f"${timestamp_field_name}"}}
-                }
-            },
-            {
-                "$group": {
-                    "_id": {
-                        "year": "$date.year",
-                        "month": "$date.month",
-                        "day": "$date.day",
-                    },
-                    "total": {"$sum": f"${field}"},
-                }
-            },
-            {"$sort": {"year": 1, "month": 1, "day": 1}},
-            {
-                "$project": {
-                    "date": {
-                        "$dateFromParts": {
-                            "year": "$_id.year",
-                            "month": "$_id.month",
-                            "day": "$_id.day",
-                        }
-                    },
-                    "total": 1,
-                }
-            },
+def sum_by_field_value(
+    collection: pymongo.collection.Collection,
+    field_to_match: str,
+    value: Any,
+    field_to_sum: str,
+    operator: str = None,
+    hint: str = None,
+):
+    """Returns sum of target field based on matching condition,
+    `hint` forces use of the named index"""
+    if operator:
+        value = {operator: value}
+
+    pipeline = [
+        {"$match": {field_to_match: value}},
+        {"$group": {"_id": None, "total": {"$sum": f"${field_to_sum}"}}},
+    ]
+    options = {"hint": hint} if hint else {}
+    doc = next(collection.aggregate(pipeline, **options), None)
+    return doc["total"] if doc else 0
+
+
+def multi_sum_by_field_value(
+    collection: pymongo.collection.Collection,
+    specs: dict,
+    union_with: str = None,
+    prefilter: dict = None,
+) -> dict:
+    """Returns sums for several SumSpecs computed in one aggregation.
+    Documents of `union_with` collection are included as well,
+    `prefilter` is applied to both collections before summing"""
+    facets = {}
+    for name, spec in specs.items():
+        value = spec.value
+        if spec.operator:
+            value = {spec.operator: value}
+        facets[name] = [
+            {"$match": {spec.field_to_match: value}},
+            {"$group": {"_id": None, "total": {"$sum": f"${spec.field_to_sum}"}}},
         ]
-        result = list(collection.aggregate(pipeline))
-        return result
 
-    @staticmethod
-    def sum_field_by_week(collection, field, timestamp_field_name="timestamp"):
-        """Returns docs with field grouped by week"""
-        pipeline = [
-            {"$addFields": {"week_number": {"$week": f"${timestamp_field_name}"}}},
-            {"$group": {"_id": "$week_number", "total": {"$sum": f"${field}"}}},
-            {"$sort": {"week": 1}},
-        ]
-        result = list(collection.aggregate(pipeline))
-        return result
+    pipeline = []
+    if prefilter:
+        pipeline.append({"$match": prefilter})
+    if union_with:
+        union_pipeline = [{"$match": prefilter}] if prefilter else []
+        pipeline.append(
+            {"$unionWith": {"coll": union_with, "pipeline": union_pipeline}}
+        )
+    pipeline.append({"$facet": facets})
+    result = next(collection.aggregate(pipeline))
+    return {
+        name: result[name][0]["total"] if result[name] else 0 for name in specs
+    }
+
+
+def sum_field_by_date(
+    collection: pymongo.collection.Collection,
+    field,
+    bucket_field_name="day_bucket",
+    min_val=None,
+    max_val=None,
+):
+    """Returns docs with field grouped by date,
+    days without records are filled with zero total.
+    If min_val and max_val are passed only days with total
+    outside of [min_val, max_val] are returned"""
+    pipeline = [
+        {
+            "$group": {
+                "_id": f"${bucket_field_name}",
+                "total": {"$sum": f"${field}"},
+            }
+        },
+        {"$project": {"_id": 0, "date": "$_id", "total": 1}},
+        {
+            "$densify": {
+                "field": "date",
+                "range": {"step": 1, "unit": "day", "bounds": "full"},
+            }
+        },
+        {"$set": {"total": {"$ifNull": ["$total", 0]}}},
+    ]
+    if min_val is not None and max_val is not None:
+        pipeline.append(
+            {"$match": {"total": {"$not": {"$gte": min_val, "$lte": max_val}}}}
+        )
+    pipeline.append({"$sort": {"date": 1}})
+    result = list(collection.aggregate(pipeline))
+    return result
+
+
+def sum_field_by_week(
+    collection,
+    field,
+    bucket_field_name="week_bucket",
+    min_val=None,
+    max_val=None,
+):
+    """Returns docs with field grouped by week,
+    weeks without records are filled with zero total.
+    If min_val and max_val are passed only weeks with total
+    outside of [min_val, max_val] are returned"""
+    pipeline = [
+        {
+            "$group": {
+                "_id": f"${bucket_field_name}",
+                "total": {"$sum": f"${field}"},
+            }
+        },
+        {"$project": {"_id": 0, "week_start": "$_id", "total": 1}},
+        {
+            "$densify": {
+                "field": "week_start",
+                "range": {"step": 1, "unit": "week", "bounds": "full"},
+            }
+        },
+        {"$set": {"total": {"$ifNull": ["$total", 0]}}},
+    ]
+    if min_val is not None and max_val is not None:
+        pipeline.append(
+            {"$match": {"total": {"$not": {"$gte": min_val, "$lte": max_val}}}}
+        )
+    pipeline.append({"$sort": {"week_start": 1}})
+    result = list(collection.aggregate(pipeline))
+    return result
+
+
+def merge_sum_by_bucket(
+    collection: pymongo.collection.Collection,
+    field: str,
+    bucket_field_name: str,
+    into: str,
+    bucket_value: Any = None,
+) -> None:
+    """Stores sums of field grouped by bucket into `into` collection,
+    only `bucket_value` bucket is recalculated if passed"""
+    if bucket_value is None:
+        bucket_value = {"$exists": True}
+    pipeline = [{"$match": {bucket_field_name: bucket_value}}]
+    pipeline += [
+        {
+            "$group": {
+                "_id": f"${bucket_field_name}",
+                "total": {"$sum": f"${field}"},
+            }
+        },
+        {"$merge": {"into": into, "on": "_id", "whenMatched": "replace"}},
+    ]
+    collection.aggregate(pipeline)
 
 
 @dataclass
@@ -107,24 +197,160 @@ class Journal:
         self.db = mongo_client.BinaryTreeJournal
         self.cut_journal = self.db.CutJournal
         self.water_journal = self.db.WaterJournal
+        self.cut_rollup = self.db.CutWeeklyRollup
+        self.water_rollup = self.db.WaterDailyRollup
+        self._rollups = {
+            self.cut_journal.name: (
+                self.cut_rollup, "number_of_branches", "week_bucket"
+            ),
+            self.water_journal.name: (
+                self.water_rollup, "water_amount", "day_bucket"
+            ),
+        }
         self.stored_actions = ["cut", "water"]
         self.max_water = 2
         self.min_water = 1
         self.max_branches = 8
         self.min_branches = 4
+        self.retention_days = 400
+        self.flush_threshold = 100
+        self._pending = {self.cut_journal.name: [], self.water_journal.name: []}
+        if "week_bucket_1" not in self.cut_journal.index_information():
+            self._set_up()
+
+    def _set_up(self) -> None:
+        """One-off creation of indexes and rollups, week_bucket index is
+        created last and marks the setup as done"""
+        self._create_indexes()
+        self._build_empty_rollups()
+        self.cut_journal.create_index(
+            [("week_bucket", pymongo.ASCENDING)], background=True
+        )
+
+    def _create_indexes(self) -> None:
+        """Creates indexes used by journal queries"""
+        for collection in (self.cut_journal, self.water_journal):
+            self._create_ttl_index(collection)
+        self.water_journal.create_index(
+            [("timestamp", pymongo.ASCENDING), ("water_amount", pymongo.ASCENDING)],
+            name="ts_water_cov",
+            background=True,
+        )
+        self.cut_journal.create_index(
+            [
+                ("timestamp", pymongo.ASCENDING),
+                ("number_of_branches", pymongo.ASCENDING),
+            ],
+            name="ts_branches_cov",
+            background=True,
+        )
+        self.water_journal.create_index(
+            [("day_bucket", pymongo.ASCENDING)], background=True
+        )
+
+    def _create_ttl_index(self, collection: pymongo.collection.Collection) -> None:
+        """Creates timestamp index removing records older than retention period,
+        plain timestamp index is converted if it already exists"""
+        expire_after = self.retention_days * 24 * 60 * 60
+        try:
+            collection.create_index(
+                [("timestamp", pymongo.ASCENDING)],
+                expireAfterSeconds=expire_after,
+                background=True,
+            )
+        except pymongo.errors.OperationFailure as error:
+            if error.code not in INDEX_CONFLICT_CODES:
+                raise
+            self.db.command(
+                "collMod",
+                collection.name,
+                index={
+                    "keyPattern": {"timestamp": 1},
+                    "expireAfterSeconds": expire_after,
+                },
+            )
+
+    def _add_missing_buckets(self, collection: pymongo.collection.Collection) -> None:
+        """Fills day_bucket and week_bucket of records written before they were
+        stored on insert"""
+        _, _, bucket_field_name = self._rollups[collection.name]
+        collection.update_many(
+            {bucket_field_name: {"$exists": False}},
+            [
+                {
+                    "$set": {
+                        "day_bucket": {
+                            "$dateTrunc": {"date": "$timestamp", "unit": "day"}
+                        },
+                        "week_bucket": {
+                            "$dateTrunc": {
+                                "date": "$timestamp",
+                                "unit": "week",
+                                "startOfWeek": "monday",
+                            }
+                        },
+                    }
+                }
+            ],
+        )
+
+    def _refresh_rollup(
+        self, collection: pymongo.collection.Collection, bucket_value: Any = None
+    ) -> None:
+        """Recalculates rollup of the journal, whole or for one bucket"""
+        rollup, field, bucket_field_name = self._rollups[collection.name]
+        merge_sum_by_bucket(
+            collection, field, bucket_field_name, rollup.name, bucket_value
+        )
+
+    def _build_empty_rollups(self) -> None:
+        """Builds rollups from the whole journal if they don't exist yet,
+        records written before buckets were stored get them first"""
+        # weekly rollup used to be keyed by week number without year
+        self.cut_rollup.delete_many({"_id": {"$not": {"$type": "date"}}})
+        for collection in (self.cut_journal, self.water_journal):
+            rollup, _, _ = self._rollups[collection.name]
+            if not rollup.estimated_document_count():
+                self._add_missing_buckets(collection)
+                self._refresh_rollup(collection)
 
     def update(self, robot: Robot, data: dict) -> None:
-        """Update DB after tree caring"""
+        """Update DB after tree caring, records are buffered until flush()"""
+        data["day_bucket"] = data["timestamp"].replace(
+            hour=0, minute=0, second=0, microsecond=0
+        )
+        data["week_bucket"] = data["day_bucket"] - timedelta(
+            days=data["day_bucket"].weekday()
+        )
         target_collection = (
             self.cut_journal if isinstance(robot, CutRobot) else self.water_journal
         )
-        target_collection.insert_one(data)
+        self._pending[target_collection.name].append(data)
+        if sum(len(docs) for docs in self._pending.values()) >= self.flush_threshold:
+            self.flush()
+
+    def flush(self) -> None:
+        """Writes buffered records to DB and refreshes affected rollups"""
+        for collection in (self.cut_journal, self.water_journal):
+            docs, self._pending[collection.name] = self._pending[collection.name], []
+            if not docs:
+                continue
+            collection.insert_many(docs, ordered=False)
+            _, _, bucket_field_name = self._rollups[collection.name]
+            for bucket_value in {doc[bucket_field_name] for doc in docs}:
+                self._refresh_rollup(collection, bucket_value)
 
     def get_required_amount_of_water(self) -> float:
         """Returns required amount of water in liters"""
-        today = datetime.today().replace(hour=0, minute=0, second=0)
-        todays_water_amount = DBHelper.sum_by_field_value(
-            self.water_journal, "timestamp", today, "water_amount", "$gte"
+        self.flush()
+        today = _today_midnight()
+        todays_water_amount = sum_by_field_value(
+            self.water_journal,
+            "timestamp",
+            today,
+            "water_amount",
+            "$gte",
+            hint="ts_water_cov",
         )
         if todays_water_amount >= self.max_water:
             return 0
@@ -132,73 +358,99 @@ class Journal:
 
     def get_number_of_branches_to_cut(self) -> int:
         """Returns required number of branches to cut"""
-        today = datetime.today().replace(hour=0, minute=0, second=0)
+        self.flush()
+        today = _today_midnight()
         monday_date = today - timedelta(days=today.weekday())
-        weeks_branches_amount = DBHelper.sum_by_field_value(
-            self.cut_journal, "timestamp", monday_date, "number_of_branches", "$gte"
+        weeks_branches_amount = sum_by_field_value(
+            self.cut_journal,
+            "timestamp",
+            monday_date,
+            "number_of_branches",
+            "$gte",
+            hint="ts_branches_cov",
         )
 
         if weeks_branches_amount >= self.max_branches:
             return 0
         return self.max_branches - weeks_branches_amount
 
+    def get_daily_status(self) -> DailyStatus:
+        """Returns required amount of water and number of branches to cut
+        using a single query over both journals"""
+        self.flush()
+        today = _today_midnight()
+        monday_date = today - timedelta(days=today.weekday())
+        totals = multi_sum_by_field_value(
+            self.water_journal,
+            {
+                "water": SumSpec("timestamp", today, "water_amount", "$gte"),
+                "branches": SumSpec(
+                    "timestamp", monday_date, "number_of_branches", "$gte"
+                ),
+            },
+            union_with=self.cut_journal.name,
+            prefilter={"timestamp": {"$gte": monday_date}},
+        )
+        return DailyStatus(
+            max(self.max_water - totals["water"], 0),
+            max(self.max_branches - totals["branches"], 0),
+        )
+
     def get_ordering_errors(self) -> list:
         """Returns list of ObjectIds of wrongly placed records in journal"""
-        collections = list(self.db.list_collection_names())
+        self.flush()
+        collections = [self.cut_journal.name, self.water_journal.name]
         ordering_errors = {collection: [] for collection in collections}
+        pipeline = [
+            {
+                "$setWindowFields": {
+                    "sortBy": {"_id": 1},
+                    "output": {
+                        "next_ts": {"$shift": {"output": "$timestamp", "by": 1}}
+                    },
+                }
+            },
+            {
+                "$match": {
+                    "next_ts": {"$ne": None},
+                    "$expr": {"$gt": ["$timestamp", "$next_ts"]},
+                }
+            },
+            {"$project": {"_id": 1}},
+        ]
         for collection in collections:
-            id_sort_res = list(self.db[collection].find().sort("_id", 1))
-            time_sort_res = list(self.db[collection].find().sort("timestamp", 1))
-            if id_sort_res != time_sort_res:
-                for i, entry in enumerate(id_sort_res[:-1]):
-                    if id_sort_res[i]["timestamp"] > id_sort_res[i + 1]["timestamp"]:
-                        ordering_errors[collection].append(entry["_id"])
+            cursor = self.db[collection].aggregate(pipeline, batchSize=500)
+            for entry in cursor:
+                ordering_errors[collection].append(entry["_id"])
 
         return ordering_errors
 
     def get_water_errors(self):
         """Returns list of dates with wrong amount of water"""
-        daily_water_data = DBHelper.sum_field_by_date(
-            self.water_journal, "water_amount"
+        self.flush()
+        daily_water_data = sum_field_by_date(
+            self.water_rollup,
+            "total",
+            bucket_field_name="_id",
+            min_val=self.min_water,
+            max_val=self.max_water,
         )
-        existing_data = [
-            DailyData(day["date"], day["total"]) for day in daily_water_data
-        ]
-        existing_data = sorted(existing_data, key=lambda x: x.date)
-        existing_dates = [day.date for day in existing_data]
-        start = existing_dates[0]
-        stop = existing_dates[-1]
-        total_days = (stop - start).days
-        for i in range(total_days):
-            next_date = start + timedelta(i)
-            if next_date not in existing_dates:
-                existing_data.append(DailyData(next_date, 0))
-        errors = [
-            day
-            for day in existing_data
-            if not (self.min_water <= day.amount <= self.max_water)
-        ]
+        errors = [DailyData(day["date"], day["total"]) for day in daily_water_data]
 
         return errors
 
     def get_cut_errors(self):
-        """Returns list of week numbers with wrong number of cut branches
-        (week numbers are relative to current year)"""
-        res = DBHelper.sum_field_by_week(self.cut_journal, "number_of_branches")
-        week_data = [WeeklyData(week["_id"], week["total"]) for week in res]
-        week_data = sorted(week_data, key=lambda x: x.week_number)
-        existing_weeks = [week.week_number for week in week_data]
-        start = week_data[0]
-        stop = week_data[-1]
-        for week_number in range(start.week_number, stop.week_number):
-            if week_number not in existing_weeks:
-                week_data.append(WeeklyData(week_number, 0))
-
-        wrong_weeks = [
-            week
-            for week in week_data
-            if not self.min_branches <= week.amount <= self.max_branches
-        ]
+        """Returns list of weeks (by their Monday date) with wrong number
+        of cut branches"""
+        self.flush()
+        res = sum_field_by_week(
+            self.cut_rollup,
+            "total",
+            bucket_field_name="_id",
+            min_val=self.min_branches,
+            max_val=self.max_branches,
+        )
+        wrong_weeks = [WeeklyData(week["week_start"], week["total"]) for week in res]
 
         return wrong_weeks
 
@@ -209,10 +461,11 @@ class Journal:
                 f'Unknown action. Should be one of {", ".join(self.stored_actions)}'
             )
 
+        self.flush()
         collection = self.cut_journal if action == "cut" else self.water_journal
         last_10_documents = collection.find().sort("_id", -1).limit(10)
-        str_res = "\n".join([str(doc) for doc in last_10_documents])
-        print(str_res)
+        for doc in last_10_documents:
+            print(doc)
 
 
 @dataclass
@@ -251,7 +504,7 @@ class WaterRobot(Robot):
                 update_data = {
                     "robot_id": self.id_number,
                     "water_amount": required_volume,
-                    "timestamp": datetime.now(),
+                    "timestamp": datetime.now(timezone.utc),
                 }
                 journal.update(self, update_data)
             else:
@@ -273,7 +526,7 @@ class CutRobot(Robot):
             update_data = {
                 "robot_id": self.id_number,
                 "number_of_branches": branches_to_cut,
-                "timestamp": datetime.now(),
+                "timestamp": datetime.now(timezone.utc),
             }
             journal.update(self, update_data)
         else:
@@ -7,10 +7,12 @@ water_robot = WaterRobot('w1', 5)
 journal = Journal(MONGO_CLIENT)
 
 try:
-    water_robot.water_tree(journal)
-except NotEnoughWaterError:
-    water_robot.refill_tank()
-    water_robot.water_tree(journal)
-
+    try:
+        water_robot.water_tree(journal)
+    except NotEnoughWaterError:
+        water_robot.refill_tank()
+        water_robot.water_tree(journal)
+finally:
+    journal.flush()
     
 